@@ -4,6 +4,7 @@ FastAPI backend with table-level parallel processing and simple progress trackin
 POST /api/extract   – JSON {"query": str, "columns": [str], "types": [str]} → CSV file
 GET  /api/health    – simple health-check
 GET  /api/progress/{task_id} – Get current progress (simple JSON endpoint)
+GET  /api/debug/routes – List registered routes
 Static files from ../frontend are served at /
 """
 from __future__ import annotations
@@ -12,40 +13,66 @@ import sys
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
 import uuid
-import gzip
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import RLock
+from concurrent.futures import ThreadPoolExecutor, wait
+import queue
+from threading import Lock
 import asyncio
 from datetime import datetime
 import time
 import os
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, JSONResponse, Response
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import itertools
+import tempfile
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel, Field
+from cachetools import TTLCache
 
 # Configuration
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
 MAX_TABLES_PER_FILE = int(os.getenv("MAX_TABLES_PER_FILE", "10"))
-
-# Add debug logging
-print("Starting app.py import...", file=sys.stderr)
-print(f"Parallel configuration: MAX_WORKERS={MAX_WORKERS}, MAX_TABLES_PER_FILE={MAX_TABLES_PER_FILE}", file=sys.stderr)
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "32"))
+RESULTS_DIR = Path(tempfile.gettempdir())
+
+# Per-table diagnostics go through the "chippy" loggers; DEBUG is off by default.
+# Workers render each record's message (QueueHandler.prepare) and enqueue it;
+# a listener thread does the stderr writes, so workers never wait on each
+# other for the stream lock.
+log = logging.getLogger("chippy.extract")
+_chippy_log = logging.getLogger("chippy")
+_chippy_log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+_log_handler = logging.StreamHandler(sys.stderr)
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_chippy_log.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Tables finished across all tasks, for periodic progress logging
+_tables_processed = itertools.count(1)
+
+log.info("Parallel configuration: MAX_WORKERS=%d, MAX_TABLES_PER_FILE=%d, INSERT_BATCH_SIZE=%d",
+         MAX_WORKERS, MAX_TABLES_PER_FILE, INSERT_BATCH_SIZE)
 
 from .utils import (
     search_patent_files,
-    extract_table_nodes,
-    is_table_relevant,
-    xml_table_to_csv,
+    store_version,
+    iter_file_tables,
+    convert_relevant_table,
 )
 
 from .formats import DatasetSchema
-from .sql import get_sql_conn, add_secondary_sql_table
+from .sql import acquire_sql_conn, release_sql_conn, discard_sql_conn, add_secondary_sql_tables, write_primary_table_csv
 
-app = FastAPI(title="Patent-Table Extractor")
+app = FastAPI(title="Patent-Table Extractor", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -54,114 +81,198 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-print("FastAPI app created, adding routes...", file=sys.stderr)
+# CSV downloads and progress polls compress very well
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # ---------------------------------------------------------------------------#
 #  Progress Tracking (Simplified)
 # ---------------------------------------------------------------------------#
-# Global progress store - simple dict with task_id -> progress data
-progress_store: Dict[str, Dict[str, Any]] = {}
-progress_lock = RLock()
+class TaskProgress:
+    """Progress data for one task, guarded by its own lock so that workers of
+    different tasks never contend with each other."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data: Dict[str, Any] = {
+            "status": "initializing",
+            "message": "Starting extraction...",
+            "total_files": 0,
+            "processed_files": 0,
+            "total_tables": 0,
+            "processed_tables": 0,
+            "relevant_tables": 0,
+            "current_action": "",
+            "errors": [],
+            "csv_path": None,
+            "created_at": datetime.now(),  # orjson serialises datetimes itself
+            "version": 0,
+            "tables": {}
+        }
+
+    def touch(self):
+        """Mark the data as changed (caller holds the lock)."""
+        self.data["updated_at"] = datetime.now()
+        self.data["version"] += 1
+
+class ProgressStore(TTLCache):
+    """TTL cache of task_id -> TaskProgress that also deletes a task's
+    result file when the task is evicted."""
+
+    @staticmethod
+    def _remove_result(task: TaskProgress):
+        if task.data.get("csv_path"):
+            Path(task.data["csv_path"]).unlink(missing_ok=True)
+
+    def popitem(self):
+        task_id, task = super().popitem()
+        self._remove_result(task)
+        return task_id, task
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, task in expired:
+            self._remove_result(task)
+        return expired
+
+# Global progress store - tasks expire 5 minutes after they were last touched.
+# TTLCache is not thread-safe, so lookups and inserts go through progress_lock;
+# everything else happens under the task's own lock.
+TASK_TTL = 300
+progress_store: ProgressStore = ProgressStore(maxsize=10_000, ttl=TASK_TTL)
+progress_lock = Lock()
+
+# (query, columns, types, store version) -> id of a task that completed cleanly.
+# Also guarded by progress_lock; an entry is only usable while its task (and
+# so its CSV) is still in the progress store, hence the same TTL.
+completed_requests: TTLCache = TTLCache(maxsize=1024, ttl=TASK_TTL)
+
+# Marker put on the table queue once every reader has finished
+_END_OF_TABLES = object()
+
+def get_task(task_id: str, create: bool = False) -> TaskProgress | None:
+    """Look up (or create) a task's progress; either way restarts its TTL."""
+    with progress_lock:
+        task = progress_store.get(task_id)
+        if task is None and create:
+            task = TaskProgress()
+        if task is not None:
+            progress_store[task_id] = task
+        return task
+
+def request_key(schema: DatasetSchema) -> tuple:
+    """Identical requests against an unchanged store give identical results."""
+    return (schema.query, tuple(schema.columns), tuple(schema.types), store_version())
+
+def find_completed_task(key: tuple) -> str | None:
+    """Return the task that already answered *key*, if its result is still on disk."""
+    with progress_lock:
+        task_id = completed_requests.get(key)
+    if task_id is None:
+        return None
+    task = get_task(task_id)
+    if task is None:
+        return None
+    with task.lock:
+        csv_path = task.data["csv_path"]
+    if not csv_path or not Path(csv_path).exists():
+        return None
+    return task_id
+
+def format_message(data: Dict[str, Any]):
+    """Fill in the human-readable message; only done when a client polls."""
+    if data["status"] == "searching_files":
+        data["message"] = "Searching patent files..."
+    elif data["status"] == "extracting_tables":
+        data["message"] = f"Extracting tables from {data['total_files']} files..."
+    elif data["status"] == "processing_tables":
+        if data['tables']:
+            data['message'] = (f"Processing {data['processed_tables']}/{data['total_tables']} tables "
+                               f"({data['relevant_tables']} relevant found)")
+            # Tables are discovered while others are processed, so the total is still growing
+            if data['processed_files'] < data['total_files']:
+                data['message'] += f", {data['processed_files']}/{data['total_files']} files read"
+        else:
+            data['message'] = f"Extracting tables from {data['total_files']} files..."
+
+    elif data["status"] == "finalizing":
+        data["message"] = "Finalizing results..."
+    elif data["status"] == "completed":
+        data["message"] = f"Completed! Found {data['relevant_tables']} relevant tables."
+    elif data["status"] == "error":
+        data["message"] = "Error occurred during processing"
 
 def update_progress(task_id: str, **kwargs):
     """Update progress for a task."""
-    with progress_lock:
-        if task_id not in progress_store:
-            progress_store[task_id] = {
-                "status": "initializing",
-                "message": "Starting extraction...",
-                "total_files": 0,
-                "processed_files": 0,
-                "total_tables": 0,
-                "processed_tables": 0,
-                "relevant_tables": 0,
-                "current_action": "",
-                "errors": [],
-                "csv_result": None,
-                "created_at": datetime.now().isoformat(),
-                "tables": {}
-            }
-        progress_store[task_id].update(kwargs)
-        progress_store[task_id]["updated_at"] = datetime.now().isoformat()
-        
-        # Create human-readable message
-        data = progress_store[task_id]
-        if data["status"] == "searching_files":
-            data["message"] = "Searching patent files..."
-        elif data["status"] == "extracting_tables":
-            data["message"] = f"Extracting tables from {data['total_files']} files..."
-        elif data["status"] == "processing_tables":
-            # Count statuses from the tables dict
-            if data['tables']:
-                processed = sum(1 for t in data['tables'].values() if t['status'] != 'pending')
-                relevant = sum(1 for t in data['tables'].values() if t['status'] == 'completed_relevant')
-                data['processed_tables'] = processed
-                data['relevant_tables'] = relevant
-                data['message'] = f"Processing {processed}/{data['total_tables']} tables ({relevant} relevant found)"
-            else:
-                data['message'] = f"Analyzing {data['total_tables']} tables..."
-
-        elif data["status"] == "finalizing":
-            data["message"] = "Finalizing results..."
-        elif data["status"] == "completed":
-            relevant = sum(1 for t in data.get('tables', {}).values() if t['status'] == 'completed_relevant')
-            data["message"] = f"Completed! Found {relevant} relevant tables."
-        elif data["status"] == "error":
-            data["message"] = "Error occurred during processing"
+    task = get_task(task_id, create=True)
+    with task.lock:
+        task.data.update(kwargs)
+        task.touch()
+
+def add_task_error(task_id: str, error: str):
+    """Record an error against a task."""
+    task = get_task(task_id)
+    if task is not None:
+        with task.lock:
+            task.data["errors"].append(error)
+            task.touch()
+
+def get_progress_version(task_id: str) -> int | None:
+    """The task's current version, without taking a snapshot of its data."""
+    task = get_task(task_id)
+    if task is None:
+        return None
+    with task.lock:
+        return task.data["version"]
 
 def get_progress(task_id: str) -> Dict[str, Any]:
     """Get progress for a task."""
-    with progress_lock:
-        return progress_store.get(task_id, {"status": "not_found"}).copy()
-
-def cleanup_old_tasks():
-    """Remove tasks older than 5 minutes."""
-    with progress_lock:
-        cutoff = datetime.now().timestamp() - 300
-        to_remove = []
-        for task_id, data in progress_store.items():
-            created = datetime.fromisoformat(data.get("created_at", datetime.now().isoformat())).timestamp()
-            if created < cutoff:
-                to_remove.append(task_id)
-        for task_id in to_remove:
-            del progress_store[task_id]
+    task = get_task(task_id)
+    if task is None:
+        return {"status": "not_found"}
+    with task.lock:
+        # Tables and errors keep growing while the task runs, so snapshot them too
+        data = task.data
+        progress = {**data, "tables": dict(data["tables"]), "errors": list(data["errors"])}
+    format_message(progress)
+    return progress
 
 # ---------------------------------------------------------------------------#
 #  Parallel Processing Functions
 # ---------------------------------------------------------------------------#
 def process_single_table(
-    table_info: Tuple[Path, int, str, int, str], 
+    table_info: Tuple[Path, int, str, str, str], 
     schema: DatasetSchema, 
     task_id: str
 ) -> Tuple[bool, str, str, str, int]:
     """Process a single table and return (is_relevant, csv, sql_command, USPTO_ID, table_no)."""
-    file_path, table_idx, table_xml, total_tables_in_file, table_uid = table_info
+    file_path, table_idx, table_xml, table_uid, USPTO_ID = table_info
     
     def set_table_status(status: str):
-        with progress_lock:
-            if task_id in progress_store and table_uid in progress_store[task_id].get("tables", {}):
-                progress_store[task_id]["tables"][table_uid]["status"] = status
-                # Also trigger a global message update
-                update_progress(task_id)
+        task = get_task(task_id)
+        if task is None:
+            return
+        with task.lock:
+            table = task.data["tables"].get(table_uid)
+            if table is not None:
+                # Keep the counters in step rather than recounting every table
+                if table["status"] == "pending":
+                    task.data["processed_tables"] += 1
+                if status == "completed_relevant":
+                    task.data["relevant_tables"] += 1
+                table["status"] = status
+                task.touch()
 
     try:
         set_table_status("processing")
         
-        USPTO_ID = file_path.stem.split('-')[0] if '-' in file_path.stem else file_path.stem.replace('.xml', '')
         table_no = table_idx + 1
         
-        print(f"[PARALLEL] Processing {file_path.name} - Table {table_no}/{total_tables_in_file}", 
-              file=sys.stderr)
-        
-        structured_table = xml_table_to_csv(table_xml)
-        if not structured_table:
-            set_table_status("completed_irrelevant")
-            return False, "", "", "", 0
+        log.debug("Processing %s - Table %d", file_path.name, table_no)
         
-        is_relevant, sql_command = is_table_relevant(structured_table, schema)
+        structured_table, sql_command = convert_relevant_table(table_xml, schema)
+        is_relevant = structured_table is not None
         
-        print(f"[PARALLEL] {file_path.name} - Table {table_no}: relevant={is_relevant}", 
-              file=sys.stderr)
+        log.debug("%s - Table %d: relevant=%s", file_path.name, table_no, is_relevant)
         
         if is_relevant:
             set_table_status("completed_relevant")
@@ -171,143 +282,202 @@ def process_single_table(
             return False, "", "", "", 0
         
     except Exception as e:
-        print(f"[ERROR] Processing {file_path.name} table {table_idx}: {e}", file=sys.stderr)
+        log.error("Processing %s table %d: %s", file_path.name, table_idx, e)
         set_table_status("error")
-        with progress_lock:
-            if task_id in progress_store:
-                progress_store[task_id]["errors"].append(f"Error in {file_path.name} table {table_idx + 1}: {str(e)}")
+        add_task_error(task_id, f"Error in {file_path.name} table {table_idx + 1}: {str(e)}")
         return False, "", "", "", 0
+    
+    finally:
+        tables_done = next(_tables_processed)
+        if tables_done % 100 == 0:
+            log.info("Processed %d tables", tables_done)
+
+def register_table(task_id: str, table_uid: str, USPTO_ID: str, table_no: int):
+    """Add a newly discovered table to the task's progress entry."""
+    task = get_task(task_id)
+    if task is None:
+        return
+    with task.lock:
+        task.data["tables"][table_uid] = {
+            "uid": table_uid,
+            "uspto_id": USPTO_ID,
+            "table_no": table_no,
+            "status": "pending"
+        }
+        task.data["total_tables"] += 1
+        task.touch()
 
-def run_extraction_background(all_table_tasks: list, schema: DatasetSchema, task_id: str):
+def read_and_split(file_path: Path, task_id: str, table_queue: queue.Queue):
+    """Queue each table of one patent file as it is parsed (or taken from the file-table cache)."""
+    USPTO_ID = file_path.stem.split('-')[0] if '-' in file_path.stem else file_path.stem.replace('.xml', '')
+
+    try:
+        for i, table_xml in enumerate(iter_file_tables(file_path, MAX_TABLES_PER_FILE)):
+            table_no = i + 1
+            table_uid = f"{USPTO_ID}-{table_no}"
+            register_table(task_id, table_uid, USPTO_ID, table_no)
+            table_queue.put((file_path, i, table_xml, table_uid, USPTO_ID))
+    except Exception as e:
+        log.error("Reading %s: %s", file_path, e)
+        add_task_error(task_id, f"Error reading {file_path.name}: {str(e)}")
+    finally:
+        task = get_task(task_id)
+        if task is not None:
+            with task.lock:
+                task.data["processed_files"] += 1
+                task.touch()
+
+def consume_tables(table_queue: queue.Queue, results: queue.Queue, schema: DatasetSchema, task_id: str):
+    """Process queued tables and pass relevant ones on to the DB writer."""
+    try:
+        while (table_info := table_queue.get()) is not _END_OF_TABLES:
+            is_relevant, csv_data, sql_command, USPTO_ID, table_no = process_single_table(table_info, schema, task_id)
+            if is_relevant:
+                results.put((csv_data, sql_command, USPTO_ID, table_no))
+    finally:
+        results.put(_END_OF_TABLES)
+
+def close_table_queue(reader_futures: list, table_queue: queue.Queue):
+    """Wait for every reader, then tell each consumer there is nothing left."""
+    wait(reader_futures)
+    for _ in range(MAX_WORKERS):
+        table_queue.put(_END_OF_TABLES)
+
+def flush_relevant_tables(conn, batch: list):
+    """Insert a batch of relevant tables into the primary table."""
+    log.debug("Adding %d relevant tables to DB", len(batch))
+    add_secondary_sql_tables(conn, batch)
+
+def run_extraction_background(schema: DatasetSchema, task_id: str, key: tuple):
     """
-    This function runs in a background thread and processes the discovered tables.
+    This function runs in a background thread. After the file search, reader
+    tasks decompress and split the matched files while consumer tasks process
+    tables as soon as they are queued, so ingest and table processing overlap.
+    Relevant tables come back to this thread, which is the only one touching
+    DuckDB. Any failure marks the task as errored so the frontend stops polling.
     """
-    print(f"[BACKGROUND] Starting processing for {len(all_table_tasks)} tables.", file=sys.stderr)
-    
-    conn = get_sql_conn(schema)
-    conn_lock = RLock()
+    try:
+        extract_tables(schema, task_id, key)
+    except Exception as e:
+        log.exception("Task %s failed", task_id)
+        add_task_error(task_id, f"Extraction failed: {str(e)}")
+        update_progress(task_id, status="error")
+
+def extract_tables(schema: DatasetSchema, task_id: str, key: tuple):
+    """Search, process and stack the tables for one task (see run_extraction_background).
+
+    *key* is the request_key taken when the request came in, before the search.
+    """
+
+    # The search decompresses every candidate file, so it runs here rather
+    # than in the request
+    matched_files = search_patent_files(schema.query)
+    update_progress(task_id, status="processing_tables", total_files=len(matched_files))
+    log.info("Task %s: starting processing for %d files", task_id, len(matched_files))
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_table = {
-            executor.submit(process_single_table, table_info, schema, task_id): table_info
-            for table_info in all_table_tasks
-        }
-        
-        print(f"[BACKGROUND] Submitted {len(future_to_table)} tasks.", file=sys.stderr)
+    conn = acquire_sql_conn(schema)
+    csv_path = RESULTS_DIR / f"chippy-{task_id}.csv"
+    try:
+        table_queue: queue.Queue = queue.Queue(maxsize=MAX_WORKERS * 4)
+        results: queue.Queue = queue.Queue()
         
-        for future in as_completed(future_to_table):
-            table_info = future_to_table[future]
-            file_path, table_idx, _, _, _ = table_info
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as readers, \
+             ThreadPoolExecutor(max_workers=MAX_WORKERS) as consumers:
+            for _ in range(MAX_WORKERS):
+                consumers.submit(consume_tables, table_queue, results, schema, task_id)
             
-            try:
-                is_relevant, csv_data, sql_command, USPTO_ID, table_no = future.result()
+            reader_futures = [readers.submit(read_and_split, file_path, task_id, table_queue) for file_path in matched_files]
+            readers.submit(close_table_queue, reader_futures, table_queue)
+            
+            finished_consumers = 0
+            batch = []
+            while finished_consumers < MAX_WORKERS:
+                result = results.get()
+                if result is _END_OF_TABLES:
+                    finished_consumers += 1
+                    continue
                 
-                if is_relevant:
-                    with conn_lock:
-                        print(f"[BACKGROUND] Adding relevant table to DB: {USPTO_ID}-{table_no}", file=sys.stderr)
-                        add_secondary_sql_table(conn, csv_data, sql_command, USPTO_ID, table_no)
-            except Exception as e:
-                print(f"[ERROR] Future result for {file_path.name} table {table_idx}: {e}", file=sys.stderr)
-
-    update_progress(task_id, status="finalizing")
-    primary_table = conn.sql("SELECT * FROM primary_table").df()
-    csv_result = primary_table.to_csv(index=False) if not primary_table.empty else ",".join(schema.columns)
+                batch.append(result)
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    flush_relevant_tables(conn, batch)
+                    batch = []
+            
+            if batch:
+                flush_relevant_tables(conn, batch)
+
+        update_progress(task_id, status="finalizing")
+        write_primary_table_csv(conn, csv_path)
+    except BaseException:
+        # The connection may be mid-transaction; never hand it to another request
+        discard_sql_conn(conn)
+        csv_path.unlink(missing_ok=True)
+        raise
+    release_sql_conn(schema, conn)
     
-    update_progress(task_id, status="completed", csv_result=csv_result)
-    print(f"[BACKGROUND] Task {task_id} complete.", file=sys.stderr)
+    update_progress(task_id, status="completed", csv_path=str(csv_path))
+    log.info("Task %s complete", task_id)
+
+    # Tasks with errors may be missing tables, so only clean runs are reused
+    task = get_task(task_id)
+    if task is not None:
+        with task.lock:
+            clean = not task.data["errors"]
+        if clean:
+            with progress_lock:
+                completed_requests[key] = task_id
 
 # ---------------------------------------------------------------------------#
 #  API routes
 # ---------------------------------------------------------------------------#
 @app.post("/api/extract")
 async def extract_data(payload: DatasetSchema):
-    print(f"Received POST request to /api/extract with payload: {payload}", file=sys.stderr)
-    
-    cleanup_old_tasks()
-    
-    task_id = str(uuid.uuid4())
-    update_progress(task_id, status="initializing")
-
-    # --- Start of synchronous discovery ---
-    update_progress(task_id, status="searching_files")
-    matched_files = search_patent_files(payload.query)
-    
-    
-    if not matched_files:
-        update_progress(task_id, status="completed", message="No matching files found.")
-        return JSONResponse({
+    log.debug("Received POST request to /api/extract with payload: %s", payload)
+
+    # A repeated request is answered by the finished task's CSV
+    key = request_key(payload)
+    task_id = find_completed_task(key)
+    if task_id is not None:
+        log.info("Task %s reused for a repeated request", task_id)
+        return ORJSONResponse({
             "task_id": task_id,
             "status": "completed",
-            "message": "No matching files or tables found.",
+            "message": "Reusing the results of an identical extraction.",
             "tables": {}
         })
-
-    update_progress(task_id, status="extracting_tables", total_files=len(matched_files))
-
-    all_table_tasks = []
-    tables_progress = {}
-    
-    for file_idx, file_path in enumerate(matched_files):
-        try:
-            with gzip.open(file_path, 'rt', errors='ignore') as f:
-                xml_text = f.read()
-            
-            xml_tables = extract_table_nodes(xml_text)
-            
-            update_progress(task_id, processed_files=file_idx + 1)
-            
-            USPTO_ID = file_path.stem.split('-')[0] if '-' in file_path.stem else file_path.stem.replace('.xml', '')
-            
-            for i, table_xml in enumerate(xml_tables[:MAX_TABLES_PER_FILE]):
-                table_no = i + 1
-                table_uid = f"{USPTO_ID}-{table_no}"
-                all_table_tasks.append((file_path, i, table_xml, len(xml_tables), table_uid))
-                tables_progress[table_uid] = {
-                    "uid": table_uid,
-                    "uspto_id": USPTO_ID,
-                    "table_no": table_no,
-                    "status": "pending"
-                }
-        except Exception as e:
-            print(f"[ERROR] Reading {file_path}: {e}", file=sys.stderr)
-            progress = get_progress(task_id)
-            update_progress(task_id, 
-                errors=progress["errors"] + [f"Error reading {file_path.name}: {str(e)}"]
-            )
     
-    update_progress(task_id, 
-        status="processing_tables",
-        total_tables=len(all_table_tasks),
-        tables=tables_progress
-    )
-    # --- End of synchronous discovery ---
-
-    if not all_table_tasks:
-        # This case is for when files are found but they contain no tables
-        update_progress(task_id, status="completed", message="Files found, but they contained no tables.")
-        return JSONResponse({
-            "task_id": task_id,
-            "status": "completed",
-            "message": "Files found, but they contained no tables.",
-            "tables": {}
-        })
+    task_id = str(uuid.uuid4())
+    update_progress(task_id, status="initializing")
+
+    update_progress(task_id, status="searching_files")
 
-    # Offload the heavy processing to a background thread
+    # Search, table discovery and processing all happen in the background
     loop = asyncio.get_running_loop()
-    loop.run_in_executor(None, run_extraction_background, all_table_tasks, payload, task_id)
+    loop.run_in_executor(None, run_extraction_background, payload, task_id, key)
 
-    # Return task ID and the initial table list immediately
-    return JSONResponse({
+    # Return the task ID immediately; tables are reported through /api/progress
+    return ORJSONResponse({
         "task_id": task_id,
-        "status": "processing_tables",
-        "message": f"Analyzing {len(all_table_tasks)} tables...",
-        "tables": tables_progress
+        "status": "searching_files",
+        "message": "Searching patent files...",
+        "tables": {}
     })
 
 @app.get("/api/progress/{task_id}")
-async def get_progress_endpoint(task_id: str):
-    """Simple JSON endpoint for progress updates."""
+async def get_progress_endpoint(task_id: str, request: Request):
+    """Simple JSON endpoint for progress updates.
+
+    The ETag is the task's version, so polls that find nothing new get an
+    empty 304 instead of the whole tables dict.
+    """
+    headers = {"Cache-Control": "no-cache"}
+    # Compare against the version alone, so an unchanged poll never copies the tables
+    version = get_progress_version(task_id)
+    if version is not None and request.headers.get("if-none-match") == f'"{task_id}-{version}"':
+        return Response(status_code=304, headers={**headers, "ETag": f'"{task_id}-{version}"'})
+
     progress = get_progress(task_id)
+    if "version" in progress:
+        headers["ETag"] = f'"{task_id}-{progress["version"]}"'
     
     # Calculate percentage
     if progress.get("total_tables", 0) > 0:
@@ -317,7 +487,14 @@ async def get_progress_endpoint(task_id: str):
     else:
         progress["percentage"] = 0
     
-    return JSONResponse(progress)
+    # The table total only becomes final once every file has been read
+    if progress.get("processed_files", 0) < progress.get("total_files", 0):
+        progress["percentage"] = min(
+            progress["percentage"],
+            int((progress["processed_files"] / progress["total_files"]) * 100)
+        )
+    
+    return ORJSONResponse(progress, headers=headers)
 
 @app.get("/api/download/{task_id}")
 async def download_csv(task_id: str):
@@ -327,36 +504,28 @@ async def download_csv(task_id: str):
     if progress.get("status") != "completed":
         raise HTTPException(status_code=400, detail="Task not completed")
     
-    csv_result = progress.get("csv_result")
-    if not csv_result:
+    csv_path = progress.get("csv_path")
+    if not csv_path or not Path(csv_path).exists():
         raise HTTPException(status_code=404, detail="No CSV result found")
     
-    return Response(
-        content=csv_result,
-        media_type="text/csv",
-        headers={
-            "Content-Disposition": "attachment; filename=patent_tables.csv"
-        }
-    )
+    return FileResponse(csv_path, media_type="text/csv", filename="patent_tables.csv")
 
 @app.get("/api/health")
 async def health():
-    return JSONResponse({"status": "ok"})
+    return ORJSONResponse({"status": "ok"})
 
-print("API routes added", file=sys.stderr)
+@app.get("/api/debug/routes")
+async def debug_routes():
+    """List the registered routes (rendered on demand, not at import)."""
+    return ORJSONResponse([
+        {"path": route.path, "name": route.name, "methods": sorted(getattr(route, "methods", None) or [])}
+        for route in app.routes
+    ])
 
 # ---------------------------------------------------------------------------#
 #  Static frontend (must be mounted **after** API routes so it doesn't
 #  shadow /api/*)
 # ---------------------------------------------------------------------------#
 FRONTEND_DIR = Path(__file__).parent.parent / "frontend"
-print(f"Mounting static files from: {FRONTEND_DIR}", file=sys.stderr)
 
 app.mount("/", StaticFiles(directory=FRONTEND_DIR, html=True), name="static")
-
-print("App setup complete", file=sys.stderr)
-
-# Print all registered routes for debugging
-print("Registered routes:", file=sys.stderr)
-for route in app.routes:
-    print(f"  {route}", file=sys.stderr)
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""Trigram index over the patent store.
+
+For every file the sorted set of its lowercased byte trigrams is kept, keyed
+by mtime and saved as plain numpy arrays outside the store (writing inside it
+would change the directory's mtime). From those an inverted index (trigram
+-> sorted file ids, stored CSR-style in two flat arrays) is built in memory, so
+a query only touches the posting lists of its own trigrams. A search then only
+has to inflate the files that contain every trigram of the query; those
+candidates are still confirmed by scanning the file itself, so results are
+exact.
+"""
+from __future__ import annotations
+
+import os
+import stat
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+log = logging.getLogger("chippy.index")
+
+INDEX_NAME = "trigrams-{}.npz"
+
+# Files indexed at once; each worker holds one widened chunk plus its codes
+INDEX_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def trigrams(chunks: Iterable[bytes]) -> np.ndarray:
+    """Return the sorted, unique 24-bit codes of every 3-byte window in the
+    concatenation of *chunks*.
+
+    Only one chunk is widened at a time and merged into the running set, so
+    memory follows the chunk size and the number of distinct trigrams, not
+    the file size. The last two bytes of each chunk are carried into the
+    next to keep the windows that straddle the boundary.
+    """
+    codes = np.empty(0, dtype=np.uint32)
+    carry = b""
+    for chunk in chunks:
+        data = carry + chunk
+        arr = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+        if len(arr) >= 3:
+            codes = np.union1d(codes, arr[:-2] << 16 | arr[1:-1] << 8 | arr[2:])
+        carry = data[-2:]
+    return codes
+
+
+class TrigramIndex:
+    """name -> (mtime_ns, trigram codes) for the files of one store directory.
+
+    Files that could not be read are stored with codes None, so they are not
+    retried (or the index re-saved) until their mtime changes.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = Lock()
+        self._files: Dict[str, Tuple[int, np.ndarray | None]] | None = None
+        # Inverted index, rebuilt whenever the file set changes
+        self._inverted = False
+        self._names: List[str] = []
+        self._unindexed: Set[str] = set()
+        self._codes = np.empty(0, dtype=np.uint32)
+        self._ids = np.empty(0, dtype=np.uint32)
+
+    def _load(self) -> Dict[str, Tuple[int, np.ndarray | None]]:
+        # Anything unreadable, foreign or not ours is dropped and rebuilt
+        try:
+            with open(self.path, "rb") as f:
+                st = os.fstat(f.fileno())
+                if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                    log.warning("Ignoring trigram index %s: not owned by us or writable by others", self.path)
+                    return {}
+                with np.load(f, allow_pickle=False) as data:
+                    names, mtimes = data["names"].tolist(), data["mtimes"].tolist()
+                    lengths, codes = data["lengths"], data["codes"].astype(np.uint32, copy=False)
+            if not len(names) == len(mtimes) == len(lengths) or lengths.clip(0).sum() != len(codes):
+                raise ValueError("inconsistent array lengths")
+            ends = np.cumsum(lengths.clip(0))
+            return {
+                name: (mtime, codes[end - n:end] if n >= 0 else None)
+                for name, mtime, n, end in zip(names, mtimes, lengths.tolist(), ends.tolist())
+            }
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning("Rebuilding unreadable trigram index %s: %s", self.path, e)
+            return {}
+
+    def _save(self) -> None:
+        names = list(self._files)
+        entries = [self._files[name] for name in names]
+        # Failed files are stored with length -1 and no codes
+        lengths = np.array([-1 if c is None else len(c) for _, c in entries], dtype=np.int64)
+        codes = [c for _, c in entries if c is not None]
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    names=np.array(names, dtype=str),
+                    mtimes=np.array([m for m, _ in entries], dtype=np.int64),
+                    lengths=lengths,
+                    codes=np.concatenate(codes) if codes else np.empty(0, dtype=np.uint32),
+                )
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("Could not persist trigram index to %s: %s", self.path, e)
+
+    def _refresh(self, paths: List[Path], read: Callable[[Path], Iterable[bytes]]) -> None:
+        """Re-index new or modified files and forget deleted ones (caller holds the lock)."""
+        if self._files is None:
+            self._files = self._load()
+
+        stale = []
+        for path in paths:
+            try:
+                mtime_ns = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            entry = self._files.get(path.name)
+            if entry is None or entry[0] != mtime_ns:
+                stale.append((path, mtime_ns))
+
+        names = {path.name for path in paths}
+        removed = [name for name in self._files if name not in names]
+        for name in removed:
+            del self._files[name]
+
+        def index_one(item):
+            path, mtime_ns = item
+            try:
+                return path.name, mtime_ns, trigrams(read(path))
+            except Exception as e:
+                log.warning("Could not index %s: %s", path, e)
+                return path.name, mtime_ns, None
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+            for name, mtime_ns, codes in executor.map(index_one, stale):
+                self._files[name] = (mtime_ns, codes)
+                failed += codes is None
+
+        if stale or removed:
+            log.info("Trigram index: %d files re-indexed, %d unreadable, %d dropped",
+                     len(stale) - failed, failed, len(removed))
+            self._save()
+            self._inverted = False
+        if not self._inverted:
+            self._invert()
+
+    def _invert(self) -> None:
+        """Rebuild the posting lists from the per-file trigram sets (caller holds the lock)."""
+        self._names = [name for name, (_, codes) in self._files.items() if codes is not None]
+        self._unindexed = {name for name, (_, codes) in self._files.items() if codes is None}
+        per_file = [self._files[name][1] for name in self._names]
+        codes = np.concatenate(per_file) if per_file else np.empty(0, dtype=np.uint32)
+        ids = np.repeat(np.arange(len(per_file), dtype=np.uint32), [len(c) for c in per_file])
+        # A stable sort keeps each posting list in ascending file id order
+        order = np.argsort(codes, kind="stable")
+        self._codes = codes[order]
+        self._ids = ids[order]
+        self._inverted = True
+
+    def _lookup(self, wanted: np.ndarray) -> Set[str]:
+        """Names of the indexed files that contain every trigram in *wanted*."""
+        lo = np.searchsorted(self._codes, wanted, side="left")
+        hi = np.searchsorted(self._codes, wanted, side="right")
+        postings = sorted((self._ids[a:b] for a, b in zip(lo, hi)), key=len)
+        hits = postings[0]
+        for ids in postings[1:]:
+            if not len(hits):
+                break
+            hits = np.intersect1d(hits, ids, assume_unique=True)
+        return {self._names[i] for i in hits.tolist()}
+
+    def candidates(self, paths: List[Path], needle: bytes,
+                   read: Callable[[Path], Iterable[bytes]]) -> Set[Path] | None:
+        """Return the files that may contain *needle* (already lowercased).
+
+        *read* yields a file's content in lowercased chunks.
+
+        None means the index cannot narrow the search: the needle is under 3
+        bytes, or it is not ASCII (files are indexed after bytes.lower(),
+        which only folds ASCII, so their trigrams can't rule such a needle
+        out). Files that could not be indexed are always kept as candidates.
+        """
+        if len(needle) < 3 or not needle.isascii():
+            return None
+        wanted = trigrams([needle])
+        with self._lock:
+            self._refresh(paths, read)
+            files = self._files
+            hits = self._lookup(wanted) | self._unindexed
+
+        return {path for path in paths if path.name in hits or path.name not in files}
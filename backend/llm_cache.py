@@ -0,0 +1,69 @@
+"""Persistent cache of LLM responses.
+
+Entries are keyed by a hash of the model, the call options (including the
+response format and its schema) and the full prompt, so a changed prompt
+template or output model never hits a stale answer. Values are
+the JSON of the parsed structured output. Least recently used entries are
+pruned once the cache grows past *max_entries*.
+"""
+from __future__ import annotations
+
+import time
+import sqlite3
+import hashlib
+import logging
+from pathlib import Path
+from threading import Lock
+
+log = logging.getLogger("chippy.llm")
+
+# How many writes between checks of the cache size
+PRUNE_EVERY = 1000
+
+
+class ResponseCache:
+    """SQLite-backed key/value store shared by all worker threads."""
+
+    def __init__(self, path: Path, max_entries: int = 200_000):
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key BLOB PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def key(model: str, prompt: str, options: str = "") -> bytes:
+        return hashlib.blake2b(f"{model}\0{options}\0{prompt}".encode("utf-8"), digest_size=20).digest()
+
+    def get(self, key: bytes) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row is not None else None
+
+    def put(self, key: bytes, value: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, used) VALUES (?, ?, ?)", (key, value, time.time())
+            )
+            self._writes += 1
+            if self._writes % PRUNE_EVERY == 0:
+                self._prune()
+
+    def delete(self, key: bytes) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _prune(self) -> None:
+        (count,) = self._conn.execute("SELECT count(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            log.info("LLM cache: pruned %d entries", count - self.max_entries)
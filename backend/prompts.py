@@ -1,10 +1,12 @@
+import sys
 import duckdb
 import json
+from functools import lru_cache
 from .sql import add_secondary_sql_table, get_sql_types, get_sql_head
 from .formats import DatasetSchema, Table
 
-def create_xml_to_csv_prompt(table_xml_str: str) -> str:
-    return f"""
+# Everything before the table XML is fixed, so it is built once
+_XML_TO_CSV_HEAD = sys.intern("""
     Using the OCR table (XML) provided, create column and table descriptions and return the table as a CSV format.
 
     Tasks:
@@ -29,22 +31,29 @@ def create_xml_to_csv_prompt(table_xml_str: str) -> str:
     - Do not merge or interpret any data
 
     Inputs:
-    table XML:{table_xml_str}"""
+    table XML:""")
 
-def create_relevance_prompt(schema: DatasetSchema, new_table: Table) -> str:
+def create_xml_to_csv_prompt(table_xml_str: str) -> str:
+    return _XML_TO_CSV_HEAD + table_xml_str
+
+@lru_cache(maxsize=128)
+def _primary_schema_desc(columns: tuple, types: tuple) -> str:
     # Create schema description for primary table
     primary_schema_desc = []
-    for col, col_type in zip(schema.columns, schema.types):
+    for col, col_type in zip(columns, types):
         primary_schema_desc.append(f"- {col} ({col_type})")
     
-    primary_schema_str = "\n    ".join(primary_schema_desc)
+    return "\n    ".join(primary_schema_desc)
+
+@lru_cache(maxsize=128)
+def _relevance_prompt_head(query: str, columns: tuple, types: tuple) -> str:
+    # Everything before the secondary table depends only on the schema
+    primary_schema_str = _primary_schema_desc(columns, types)
 
-    newline_char = '\n'
-    
     return f"""
     Evaluate if the secondary table is compatible with the primary table for stacking (INSERT INTO).
 
-    Goal: {schema.query}
+    Goal: {query}
 
     Tasks:
     1. Check compatibility:
@@ -66,7 +75,15 @@ def create_relevance_prompt(schema: DatasetSchema, new_table: Table) -> str:
         {primary_schema_str}
 
     Secondary Table:
-    Description: {new_table.table_description}
+"""
+
+def create_relevance_prompt(schema: DatasetSchema, new_table: Table) -> str:
+    # Every table of a request shares the schema, so the prompt head is cached
+    head = _relevance_prompt_head(schema.query, tuple(schema.columns), tuple(schema.types))
+
+    newline_char = '\n'
+    
+    return head + f"""    Description: {new_table.table_description}
     Columns: {["USPTO_ID", "Table_No"] + [col.column_name + ": " + col.description for col in new_table.column_descriptions]}
     Data Sample: {new_table.csv.split(newline_char)[0:3]}
     """
\ No newline at end of file
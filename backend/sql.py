@@ -1,54 +1,145 @@
 import duckdb
+import orjson
+from io import StringIO
+from pathlib import Path
 from .formats import DatasetSchema
-import sys
+import logging
+import queue
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
 
-def get_sql_conn(schema: DatasetSchema) -> duckdb.duckdb.DuckDBPyConnection:
+log = logging.getLogger("chippy.sql")
 
-    conn = duckdb.connect()
+# Idle connections kept per schema shape
+CONN_POOL_SIZE = 4
+# Schema shapes with pooled connections; the least recently used is closed first
+CONN_POOL_SCHEMAS = 16
+
+_conn_pool: OrderedDict[tuple, queue.LifoQueue] = OrderedDict()
+_conn_pool_lock = Lock()
 
+# Everything a request (or an LLM-written sql_command) can leave behind in the
+# catalog or the session; a pooled connection must look exactly like a fresh one
+_CATALOG_SQL = """
+SELECT 'column', table_name, column_name, data_type FROM duckdb_columns() WHERE NOT internal
+UNION ALL SELECT 'sequence', sequence_name, NULL, NULL FROM duckdb_sequences()
+UNION ALL SELECT 'index', index_name, table_name, NULL FROM duckdb_indexes()
+UNION ALL SELECT 'macro', function_name, NULL, NULL FROM duckdb_functions() WHERE NOT internal
+UNION ALL SELECT 'database', database_name, NULL, NULL FROM duckdb_databases() WHERE NOT internal
+UNION ALL SELECT 'type', type_name, logical_type, NULL FROM duckdb_types() WHERE NOT internal
+UNION ALL SELECT 'setting', name, value::VARCHAR, NULL FROM duckdb_settings()
+UNION ALL SELECT 'variable', name, value::VARCHAR, type FROM duckdb_variables()
+ORDER BY ALL
+"""
+
+@lru_cache(maxsize=128)
+def _schema_ddl(columns: tuple, types: tuple) -> str:
     # Create column definitions from schema
     column_definitions = []
-    for column_name, column_type in zip(schema.columns, schema.types):
+    for column_name, column_type in zip(columns, types):
         quoted_name = f'"{column_name}"'
         column_definitions.append(f"{quoted_name} {column_type}")    
     columns_sql = ",\n        ".join(column_definitions)
     
-    create_table_sql = f"""
+    return f"""
     CREATE TABLE primary_table (
         {columns_sql}
     );
     """
-    
-    conn.execute(create_table_sql)
+
+def get_sql_conn(schema: DatasetSchema) -> duckdb.duckdb.DuckDBPyConnection:
+
+    conn = duckdb.connect()
+    conn.execute(_schema_ddl(tuple(schema.columns), tuple(schema.types)))
     
     return conn
 
+def _catalog(conn: duckdb.duckdb.DuckDBPyConnection) -> list:
+    return conn.execute(_CATALOG_SQL).fetchall()
+
+@lru_cache(maxsize=128)
+def _fresh_catalog(columns: tuple, types: tuple) -> tuple:
+    conn = duckdb.connect()
+    try:
+        conn.execute(_schema_ddl(columns, types))
+        return tuple(_catalog(conn))
+    finally:
+        conn.close()
+
+def _conn_pool_for(key: tuple) -> queue.LifoQueue:
+    """The idle connections for one schema shape (caller holds _conn_pool_lock)."""
+    pool = _conn_pool.get(key)
+    if pool is None:
+        pool = _conn_pool[key] = queue.LifoQueue(maxsize=CONN_POOL_SIZE)
+        if len(_conn_pool) > CONN_POOL_SCHEMAS:
+            _, evicted = _conn_pool.popitem(last=False)
+            while not evicted.empty():
+                evicted.get_nowait().close()
+    else:
+        _conn_pool.move_to_end(key)
+    return pool
+
+def acquire_sql_conn(schema: DatasetSchema) -> duckdb.duckdb.DuckDBPyConnection:
+    """Return a connection with an empty primary_table, reusing a warm one if possible
+    (pooled connections are emptied when released)."""
+    key = (tuple(schema.columns), tuple(schema.types))
+    try:
+        with _conn_pool_lock:
+            return _conn_pool_for(key).get_nowait()
+    except queue.Empty:
+        return get_sql_conn(schema)
+
+def release_sql_conn(schema: DatasetSchema, conn: duckdb.duckdb.DuckDBPyConnection) -> None:
+    """Hand a connection back to the pool, closing it if the pool is full or
+    the request left anything behind besides rows in primary_table."""
+    key = (tuple(schema.columns), tuple(schema.types))
+    try:
+        # Idle connections shouldn't hold on to the last request's rows
+        conn.execute("DELETE FROM primary_table")
+        conn.execute("DROP TABLE IF EXISTS secondary_table")
+        conn.execute("DROP TABLE IF EXISTS csv_read")
+        clean = tuple(_catalog(conn)) == _fresh_catalog(*key)
+    except duckdb.Error:
+        clean = False
+    if not clean:
+        log.debug("Closing a DuckDB connection whose catalog was modified")
+        conn.close()
+        return
+    try:
+        with _conn_pool_lock:
+            _conn_pool_for(key).put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def discard_sql_conn(conn: duckdb.duckdb.DuckDBPyConnection) -> None:
+    """Close a connection that must not go back to the pool (e.g. after a failure)."""
+    try:
+        conn.close()
+    except duckdb.Error as e:
+        log.warning("Closing a discarded DuckDB connection: %s", e)
+
 def add_secondary_sql_table(conn: duckdb.duckdb.DuckDBPyConnection, csv: str, sql_command: str = "", USPTO_ID: str = "", table_no: int = 0) -> bool:
 
     try: 
-        with open('/tmp/secondary_table.csv', 'w') as f:
-            f.write(csv)
-
         conn.execute("DROP TABLE IF EXISTS secondary_table;")
         conn.execute("DROP TABLE IF EXISTS csv_read;")
 
-        conn.execute("""
-        CREATE TABLE csv_read AS 
-        SELECT * FROM read_csv_auto('/tmp/secondary_table.csv',
-            header=true,
-            nullstr='NA',
+        # Read the CSV straight from memory rather than through a shared temp file
+        csv_read = conn.read_csv(
+            StringIO(csv),
+            header=True,
+            na_values='NA',
             sample_size=-1,
             auto_type_candidates=['BIGINT'],
-            ignore_errors=true
-        );
-        """)
+            ignore_errors=True
+        )
+        csv_read.to_table("csv_read")
 
-        # filter out empty rows:
-
-        columns = conn.execute("PRAGMA table_info(csv_read)").fetchall()
-        column_names = [col[1] for col in columns]
+        # filter out empty rows; the relation already knows its columns, so
+        # no PRAGMA round-trip is needed
         
-        conditions = " AND ".join([f"{col} IS NULL" for col in column_names])
+        conditions = " AND ".join(['"{}" IS NULL'.format(col.replace('"', '""')) for col in csv_read.columns])
 
         # Add USPTO_ID and Table_No columns to the filtered data
         conn.execute(f"""
@@ -62,27 +153,45 @@ def add_secondary_sql_table(conn: duckdb.duckdb.DuckDBPyConnection, csv: str, sq
         
         # Execute the SQL command from the relevance check if provided
         if sql_command:
-            print(f"Executing SQL command: {sql_command}", file=sys.stderr)
+            log.debug("Executing SQL command: %s", sql_command)
             conn.execute(sql_command)
     
     except Exception as e:
-        print(f"Error in add_secondary_sql_table: {e}", file=sys.stderr)
+        log.error("Error in add_secondary_sql_table: %s", e)
         return False
     
     return True
 
+def add_secondary_sql_tables(conn: duckdb.duckdb.DuckDBPyConnection, batch: list) -> int:
+    """Stack a batch of (csv, sql_command, USPTO_ID, table_no) tables in one transaction.
+
+    A failing LLM-written statement aborts the whole DuckDB transaction, so in
+    that case the batch is rolled back and replayed one table at a time.
+    Returns the number of tables added.
+    """
+    conn.execute("BEGIN TRANSACTION")
+    if all(add_secondary_sql_table(conn, *item) for item in batch):
+        conn.execute("COMMIT")
+        return len(batch)
+
+    conn.execute("ROLLBACK")
+    return sum(add_secondary_sql_table(conn, *item) for item in batch)
+
 def get_sql_types(conn: duckdb.duckdb.DuckDBPyConnection) -> dict:
     
-    secondary_table_metadata = conn.execute("DESCRIBE secondary_table").df()
-    secondary_table_metadata = dict(zip(secondary_table_metadata['column_name'], secondary_table_metadata['column_type']))
-
-    return secondary_table_metadata
+    # DESCRIBE rows start with (column_name, column_type, ...)
+    rows = conn.execute("DESCRIBE secondary_table").fetchall()
+    return {row[0]: row[1] for row in rows}
 
 def get_sql_head(conn: duckdb.duckdb.DuckDBPyConnection) -> str:
-    # Execute a SQL query to get the first row from the secondary_table
-    data_head_df = conn.execute("SELECT * FROM secondary_table LIMIT 3").df()
+    # Fetch the first rows of the secondary_table as plain tuples
+    cursor = conn.execute("SELECT * FROM secondary_table LIMIT 3")
+    columns = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
 
-    # Convert the DataFrame to a JSON string
-    data_head_str = data_head_df.to_json(orient='records')
+    # Encode them as JSON records; str() covers types like DECIMAL
+    return orjson.dumps([dict(zip(columns, row)) for row in rows], default=str).decode()
 
-    return data_head_str
\ No newline at end of file
+def write_primary_table_csv(conn: duckdb.duckdb.DuckDBPyConnection, csv_path: Path) -> None:
+    # DuckDB's own CSV writer streams the result to disk without a Python hop
+    conn.execute(f"COPY (SELECT * FROM primary_table) TO '{csv_path}' (HEADER, FORMAT CSV)")
\ No newline at end of file
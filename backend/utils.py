@@ -3,18 +3,42 @@ merging) is stubbed so the app runs instantly out-of-the-box."""
 from __future__ import annotations
 
 import os
+import re
+import csv
+import codecs
 import random
+import logging
+import hashlib
+import sqlite3
+import tempfile
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
 from pathlib import Path
-from typing import List
+from typing import BinaryIO, Iterator, List
 from xml.etree import ElementTree as ET
+from lxml import etree
 from dotenv import load_dotenv
 from openai import OpenAI
+from pydantic import ValidationError
+import orjson
 import pandas as pd
-from io import StringIO
-import gzip
+from io import BytesIO, StringIO
+
+# ISA-L's inflate is a drop-in for the stdlib decoder and several times faster
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
 from .prompts import create_xml_to_csv_prompt, create_relevance_prompt
 from .formats import Table, DatasetSchema, SQL
+from .index import TrigramIndex, INDEX_NAME
+from .llm_cache import ResponseCache
+
+log = logging.getLogger("chippy.llm")
 
 
 # Initialize OpenAI client
@@ -29,71 +53,415 @@ else:
    # Running in Modal or local
    XML_DIR = Path("/app/patents")
 
+# Persistent LLM response cache; set LLM_CACHE_PATH to an empty string to disable
+_llm_cache_path = os.getenv("LLM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "chippy-llm-cache.sqlite"))
+llm_cache: ResponseCache | None = None
+if _llm_cache_path:
+    try:
+        llm_cache = ResponseCache(Path(_llm_cache_path))
+    except sqlite3.Error as e:
+        log.warning("LLM cache disabled, could not open %s: %s", _llm_cache_path, e)
+
 
 # ---------------------------------------------------------------------------#
 #  XML search helpers
 # ---------------------------------------------------------------------------#
+@lru_cache(maxsize=8)
+def _listing(xml_dir: Path, mtime_ns: int) -> tuple[Path, ...]:
+    """Sorted .xml.gz files of *xml_dir*; cached until the directory's mtime
+    changes (i.e. files are added, removed or renamed)."""
+    with os.scandir(xml_dir) as entries:
+        return tuple(sorted(xml_dir / entry.name for entry in entries if entry.name.endswith(".xml.gz")))
+
+@lru_cache(maxsize=8)
+def _fingerprint(xml_dir: Path, mtime_ns: int) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for path in _listing(xml_dir, mtime_ns):
+        try:
+            file_mtime_ns = path.stat().st_mtime_ns
+        except OSError:
+            continue
+        digest.update(f"{path.name}\0{file_mtime_ns}\0".encode("utf-8"))
+    return digest.digest()
+
+def store_version() -> bytes:
+    """Fingerprint of the store's patent files (names and mtimes).
+
+    Like the listing it is only recomputed when the directory's mtime
+    changes, so a request costs one stat; other files written to the
+    directory don't change the fingerprint itself. Stored patents are not
+    rewritten in place.
+    """
+    try:
+        mtime_ns = XML_DIR.stat().st_mtime_ns
+    except OSError:
+        return b""
+    return _fingerprint(XML_DIR, mtime_ns)
+
 def _iter_xml_files(limit: int | None = None):
     """Yield Path objects for .xml files in the store (depth-1)."""
-    for i, path in enumerate(sorted(XML_DIR.glob("*.xml.gz"))):
-        if limit and i >= limit:
+    try:
+        mtime_ns = XML_DIR.stat().st_mtime_ns
+    except OSError:
+        return
+    for i, path in enumerate(_listing(XML_DIR, mtime_ns)):
+        if limit is not None and i >= limit:
             break
         yield path
 
+SEARCH_CHUNK_SIZE = 1 << 20
+INDEX_CHUNK_SIZE = 1 << 18
+SEARCH_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+
+def _file_contains(path: Path, needle: bytes) -> bool:
+    """Stream a gzipped file in 1 MiB chunks and stop at the first hit of
+    the (lowercased) needle.
+
+    An ASCII needle is matched against lowercased bytes, so no str is ever
+    decoded. bytes.lower() only folds ASCII, though, so a needle with
+    non-ASCII characters is matched against decoded chunks lowered with
+    str.lower() instead, as the file's decoded text would be. Either way the
+    last len(needle) - 1 items of each window are carried over to catch
+    matches that straddle a chunk boundary.
+    """
+    if needle.isascii():
+        lower = bytes.lower
+    else:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        lower = lambda chunk: decoder.decode(chunk).lower()
+        needle = needle.decode("utf-8")
+
+    carry = None
+    with gzip.open(path, 'rb') as f:
+        while chunk := f.read(SEARCH_CHUNK_SIZE):
+            window = lower(chunk) if carry is None else carry + lower(chunk)
+            if needle in window:
+                return True
+            carry = window[-(len(needle) - 1):] if len(needle) > 1 else window[:0]
+    return False
+
+def _iter_lower(path: Path) -> Iterator[bytes]:
+    """A gzipped file's content in lowercased chunks, for the trigram index."""
+    with gzip.open(path, 'rb') as f:
+        while chunk := f.read(INDEX_CHUNK_SIZE):
+            yield chunk.lower()
+
+@lru_cache(maxsize=None)
+def _trigram_index(xml_dir: Path) -> TrigramIndex:
+    # Kept out of the store itself, whose mtime versions the file listing, in
+    # a per-user 0700 cache directory with one file per store
+    if os.getenv("INDEX_PATH"):
+        return TrigramIndex(Path(os.environ["INDEX_PATH"]))
+    store = hashlib.blake2b(str(xml_dir.resolve()).encode(), digest_size=8).hexdigest()
+    cache_dir = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "chippy"
+    return TrigramIndex(cache_dir / INDEX_NAME.format(store))
+
+def _scan_one(path: Path, needle: bytes, candidates: set[Path] | None = None) -> bool | None:
+    """Scan one file; None means it could not be read."""
+    if candidates is not None and path not in candidates:
+        return False  # the trigram index rules it out
+    try:
+        return _file_contains(path, needle)
+    except Exception:
+        return None
+
+# Query matching is disabled for testing on 1 file, so by default the search
+# returns the first files of the store without reading them. Set
+# SEARCH_MATCH_QUERY=1 to only return files whose text contains the query.
+SEARCH_MATCH_QUERY = os.getenv("SEARCH_MATCH_QUERY", "0") == "1"
+
 def search_patent_files(query: str, limit: int = 3) -> List[Path]:
-    """Return the first *limit* patent files whose raw text contains *query*."""
-    query = query.lower()
-    matches: list[Path] = []
-    for path in _iter_xml_files():
-        try:
-            with gzip.open(path, 'rt', encoding='utf-8', errors='ignore') as f:
-                text = f.read().lower()
-        except Exception:
-            continue
+    """Return the first *limit* patent files whose raw text contains *query*
+    (just the first *limit* files while SEARCH_MATCH_QUERY is off).
 
-        if query in text:
-            pass # check if the text contains the query - disabled for testing on 1 file!
-        
-        matches.append(path)
-        
-        if len(matches) == limit:
-            break
+    The trigram index narrows the files worth inflating; those are scanned in
+    parallel (inflate releases the GIL) but results are taken in sorted
+    order, so the answer is the same as a serial scan.
+    """
+    if limit <= 0:
+        return []
+    if not SEARCH_MATCH_QUERY:
+        return list(_iter_xml_files(limit))
+
+    needle = query.lower().encode("utf-8")
+    paths = list(_iter_xml_files())
+    matches: list[Path] = []
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as pool:
+        candidates = _trigram_index(XML_DIR).candidates(paths, needle, _iter_lower)
+        futures = [pool.submit(_scan_one, path, needle, candidates) for path in paths]
+        for path, future in zip(paths, futures):
+            # None (unreadable) counts as no match
+            if future.result():
+                matches.append(path)
+                if len(matches) >= limit:
+                    break
+        # Files after the last match are not needed
+        pool.shutdown(wait=False, cancel_futures=True)
     return matches
 
 # ---------------------------------------------------------------------------#
 #  Table extraction
 # ---------------------------------------------------------------------------#
-def extract_table_nodes(xml_text: str) -> List[str]:
-    """Return raw XML strings for every <table>...</table> element."""
+def _iter_table_xml(source: BinaryIO) -> Iterator[str]:
+    """Yield every top-level <table> in *source* as an XML string.
+
+    iterparse pulls the stream incrementally. Every finished element outside
+    a table (and each table once serialised) is cleared along with the
+    siblings before it, so the tree only ever holds the path to the current
+    element plus the table being read.
+    """
+    for _, elem in etree.iterparse(source, events=("end",), huge_tree=True, recover=True):
+        if next(elem.iterancestors("table"), None) is not None:
+            continue  # part of a table, serialised with it
+        if elem.tag == "table":
+            yield etree.tostring(elem, encoding="unicode", with_tail=False)
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+# Total size of the table XML kept by the file-table cache
+FILE_TABLES_CACHE_CHARS = 64 << 20
+
+# (path, mtime_ns, limit) -> tables, least recently used first
+_file_tables_cache: OrderedDict[tuple, tuple[str, ...]] = OrderedDict()
+_file_tables_chars = 0
+_file_tables_lock = Lock()
+
+def _cache_file_tables(key: tuple, tables: tuple[str, ...]) -> None:
+    global _file_tables_chars
+    size = sum(map(len, tables))
+    if size > FILE_TABLES_CACHE_CHARS:
+        return
+    with _file_tables_lock:
+        if key in _file_tables_cache:
+            return
+        _file_tables_cache[key] = tables
+        _file_tables_chars += size
+        while _file_tables_chars > FILE_TABLES_CACHE_CHARS:
+            _, evicted = _file_tables_cache.popitem(last=False)
+            _file_tables_chars -= sum(map(len, evicted))
+
+def iter_file_tables(path: Path, limit: int) -> Iterator[str]:
+    """Yield the first *limit* <table> strings of a patent file.
+
+    Stored patents don't change, so the tables are cached on the file's
+    mtime (LRU, bounded by total size) and repeat queries skip inflate and
+    iterparse. On a miss each table is yielded as soon as it is parsed.
+    """
+    key = (path, path.stat().st_mtime_ns, limit)
+    with _file_tables_lock:
+        tables = _file_tables_cache.get(key)
+        if tables is not None:
+            _file_tables_cache.move_to_end(key)
+    if tables is not None:
+        yield from tables
+        return
+
+    parsed: list[str] = []
+    with gzip.open(path, 'rb') as raw:
+        try:
+            # islice stops before pulling a table past the limit
+            for table_xml in islice(_iter_table_xml(raw), max(limit, 0)):
+                parsed.append(table_xml)
+                yield table_xml
+        except etree.XMLSyntaxError:
+            pass
+    # Only reached when the caller read every table; read errors propagate
+    _cache_file_tables(key, tuple(parsed))
+
+
+def extract_table_nodes(xml_text: str | bytes) -> List[str]:
+    """Return raw XML strings for every <table>...</table> element.
+
+    Pass bytes (e.g. ``path.read_bytes()``) to skip the UTF-8 re-encode.
+    """
+    if isinstance(xml_text, str):
+        xml_text = xml_text.encode("utf-8")
     try:
-        root = ET.fromstring(xml_text)
-    except ET.ParseError:
+        return list(_iter_table_xml(BytesIO(xml_text)))
+    except etree.XMLSyntaxError:
         return []
-    tables = root.findall(".//table")
-    return [ET.tostring(t, encoding="unicode") for t in tables]
+
+
+# A digit in text content (between tags, skipping entity references), as
+# opposed to one in an attribute such as colwidth="28pt"
+_TEXT_DIGIT = re.compile(r">(?:[^<&]|&[^;<]*;)*?\d")
+
+# Filled in from the patent itself, not from the table; the frontend always
+# sends them as TEXT columns
+_METADATA_COLUMNS = ("USPTO_ID", "Table_No")
+
+def _all_numeric(schema: DatasetSchema) -> bool:
+    """True if every user-requested column (metadata aside) is NUMERIC."""
+    types = [t for c, t in zip(schema.columns, schema.types) if c not in _METADATA_COLUMNS]
+    return bool(types) and all(t == "NUMERIC" for t in types)
+
+
+def table_has_data_rows(table_xml: str, chunk_size: int = 4096) -> bool:
+    """Return True if the table body holds at least one row with text.
+
+    Tables without one (title-only or empty layout tables) can never add rows
+    to the primary table, so they are rejected before any LLM call. The XML is
+    pull-parsed in small chunks and the scan stops at the first such row, so
+    typical tables are decided from their first few kilobytes.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    body_depth = 0
+    saw_body = False
+    loose_text_row = False  # a row with text outside any <tbody>
+    try:
+        for offset in range(0, len(table_xml), chunk_size):
+            parser.feed(table_xml[offset:offset + chunk_size])
+            for event, elem in parser.read_events():
+                if elem.tag == "tbody":
+                    saw_body = True
+                    body_depth += 1 if event == "start" else -1
+                elif event == "end" and elem.tag == "row":
+                    if any("".join(entry.itertext()).strip() for entry in elem.iter("entry")):
+                        if body_depth:
+                            return True
+                        loose_text_row = True
+        parser.close()
+    except ET.ParseError:
+        return True  # let the LLM judge tables we cannot parse
+    return loose_text_row and not saw_body
 
 
 # ---------------------------------------------------------------------------#
 #  LLM Calls
 # ---------------------------------------------------------------------------#
+TABLE_CACHE_SIZE = 8192
 
-def is_table_relevant(table: Table, schema: DatasetSchema) -> tuple[bool, str]:
-    """Check if the table is relevant to the requested columns."""
+# table hash + schema -> Future of (structured_table, sql_command), in LRU order
+_table_cache: OrderedDict[tuple, Future] = OrderedDict()
+_table_cache_lock = Lock()
+_WHITESPACE = re.compile(r"\s+")
 
-    prompt = create_relevance_prompt(schema, table)
 
-    print("PROMPT: ", prompt)
+@lru_cache(maxsize=None)
+def _response_format_id(response_format) -> str:
+    """Name plus a hash of the JSON schema, so a changed model never hits
+    answers cached for its old shape."""
+    schema = orjson.dumps(response_format.model_json_schema(), option=orjson.OPT_SORT_KEYS)
+    return f"{response_format.__name__}:{hashlib.blake2b(schema, digest_size=8).hexdigest()}"
+
+def parse_completion(model: str, prompt: str, response_format, **options):
+    """Structured-output completion, answered from the persistent cache when
+    the same model, response format, options and prompt were seen before."""
+    key = None
+    if llm_cache is not None:
+        key = llm_cache.key(model, prompt, f"{_response_format_id(response_format)}\0{sorted(options.items())!r}")
+        cached = llm_cache.get(key)
+        if cached is not None:
+            try:
+                return response_format.model_validate_json(cached)
+            except ValidationError as e:
+                log.warning("Dropping unreadable cached %s response: %s", response_format.__name__, e)
+                llm_cache.delete(key)
 
-    response = client.beta.chat.completions.parse(
-        model="gpt-4.1",
+    parsed = client.beta.chat.completions.parse(
+        model=model,
         messages=[
             {"role": "user", "content": prompt}
         ],
-        response_format=SQL,
+        response_format=response_format,
+        **options,
     ).choices[0].message.parsed
 
+    if key is not None and parsed is not None:
+        llm_cache.put(key, parsed.model_dump_json())
+    return parsed
+
+def is_table_relevant(table: Table, schema: DatasetSchema) -> tuple[bool, str]:
+    """Check if the table is relevant to the requested columns."""
+
+    prompt = create_relevance_prompt(schema, table)
+
+    log.debug("PROMPT: %s", prompt)
+
+    response = parse_completion("gpt-4.1", prompt, SQL)
+
     return response.is_relevant, response.sql_command
 
+def convert_relevant_table(table_xml: str, schema: DatasetSchema) -> tuple[Table | None, str]:
+    """Return the structured table and the SQL command that stacks it into the
+    primary table, or (None, "") if the table is not relevant.
+
+    Results are memoised by a hash of the table XML (with whitespace runs
+    collapsed, so reflowed copies match) and the schema, so tables repeated
+    within or across patents cost one set of LLM calls. Concurrent
+    callers with the same key wait for the first one instead of racing it.
+    """
+    key = (
+        hashlib.blake2b(_WHITESPACE.sub(" ", table_xml).encode("utf-8"), digest_size=16).digest(),
+        schema.query,
+        tuple(schema.columns),
+        tuple(schema.types),
+    )
+    with _table_cache_lock:
+        future = _table_cache.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _table_cache[key] = Future()
+            if len(_table_cache) > TABLE_CACHE_SIZE:
+                _table_cache.popitem(last=False)
+        else:
+            _table_cache.move_to_end(key)
+
+    if is_owner:
+        try:
+            future.set_result(_convert_relevant_table(table_xml, schema))
+        except Exception as e:
+            # Don't cache failures; the next occurrence gets a fresh attempt
+            with _table_cache_lock:
+                _table_cache.pop(key, None)
+            future.set_exception(e)
+    return future.result()
+
+def _convert_relevant_table(table_xml: str, schema: DatasetSchema) -> tuple[Table | None, str]:
+    """Run the per-table pipeline, stopping at the first stage that rejects it."""
+    if not table_has_data_rows(table_xml):
+        return None, ""
+    if _all_numeric(schema) and not _TEXT_DIGIT.search(table_xml):
+        log.debug("Skipping table without digits for an all-numeric schema")
+        return None, ""
+
+    structured_table = xml_table_to_csv(table_xml)
+    if not structured_table:
+        return None, ""
+
+    is_relevant, sql_command = is_table_relevant(structured_table, schema)
+    if not is_relevant:
+        return None, ""
+    return structured_table, sql_command
+
+def _is_valid_csv(csv_text: str) -> bool:
+    """Cheap lexical stand-in for pd.read_csv: a header and at least one data
+    row, with no row wider than the header."""
+    try:
+        rows = csv.reader(StringIO(csv_text), strict=True)
+        header = next(rows, None)
+        if not header:
+            return False
+        has_data = False
+        for row in rows:
+            if not row:
+                continue  # blank line
+            if len(row) > len(header):
+                return False
+            has_data = True
+        return has_data
+    except csv.Error:
+        return False
+
+# Newlines become spaces and quotes are doubled, in one pass over the string
+_FALLBACK_ESCAPE = str.maketrans({"\n": " ", '"': '""'})
+
+def _fallback_csv(table_xml: str) -> str:
+    """Single quoted CSV cell holding the raw table XML."""
+    return f'"{table_xml.translate(_FALLBACK_ESCAPE)}"\n'
+
 def xml_table_to_csv(table_xml: str) -> str:
     """Convert XML table to CSV using OpenAI API.
     
@@ -108,34 +476,18 @@ def xml_table_to_csv(table_xml: str) -> str:
         prompt = create_xml_to_csv_prompt(table_xml)
         
         # Call OpenAI API with structured outputs
-        response = client.beta.chat.completions.parse(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            response_format=Table,
-            temperature=0.0,
-        )
-        
-        # Extract the structured response
-        structured_table = response.choices[0].message.parsed
+        structured_table = parse_completion("gpt-4.1-mini", prompt, Table, temperature=0.0)
         
         if not structured_table or not structured_table.csv:
-            print("Warning: OpenAI returned empty or invalid CSV, falling back to dummy implementation")
-            safe = table_xml.replace("\n", " ").replace('"', '""')
-            return f'"{safe}"\n'
+            log.warning("OpenAI returned empty or invalid CSV, falling back to dummy implementation")
+            return _fallback_csv(table_xml)
         
         # Log the table description for debugging/monitoring
-        print(f"Table description: {structured_table.table_description}")
+        log.debug("Table description: %s", structured_table.table_description)
         
         # test if the csv is valid
-        try:
-            df = pd.read_csv(StringIO(structured_table.csv))
-            if df.empty:
-                print("CSV is empty")
-                return False
-        except Exception as e:
-            print(f"Invalid CSV format: {e}")
+        if not _is_valid_csv(structured_table.csv):
+            log.debug("CSV is empty or malformed")
             return False
         
         structured_table.csv = fix_cell_overflow(structured_table.csv)
@@ -143,12 +495,10 @@ def xml_table_to_csv(table_xml: str) -> str:
         return structured_table
         
     except Exception as e:
-        print(f"Error calling OpenAI API: {e}")
-        print("Falling back to dummy implementation")
+        log.error("Error calling OpenAI API: %s; falling back to dummy implementation", e)
         # Fallback to original dummy implementation on any error
-        safe = table_xml.replace("\n", " ").replace('"', '""')
-        print(table_xml)
-        return f'"{safe}"\n'
+        log.debug("Table XML: %s", table_xml)
+        return _fallback_csv(table_xml)
     
 
 # ---------------------------------------------------------------------------#
@@ -159,23 +509,26 @@ def fix_cell_overflow(csv: str) -> str:
 
     df = pd.read_csv(StringIO(csv))
 
-    new_df = pd.DataFrame()
-    for idx, row in df.iterrows():
-        num_not_na = row.notna().sum()
-        if num_not_na == 0:
-            continue
-        elif num_not_na == 1 or num_not_na == 2:
-            # check if the non-NA values are strings, not numeric:
-            # if so, concatenate the values to the previous row.
-            if len(new_df) > 0:  # Make sure there's a previous row
-                # Find the columns with non-NA values
-                non_na_cols = row.dropna().index
-                all_strings = all(isinstance(row[col], str) for col in non_na_cols)
-                
-                if all_strings:
-                    # Concatenate each string value to the corresponding column in the previous row
-                    for col in non_na_cols:
-                        new_df.loc[new_df.index[-1], col] += row[col]
-        else:
-            new_df = pd.concat([new_df, pd.DataFrame(row).T])
-    return new_df.to_csv(index=False, na_rep='NA', quoting=1)
\ No newline at end of file
+    # Rows with three or more cells are real rows. Rows with only one or two
+    # cells, all of them text, are overflow from the real row above: their
+    # text is appended to it. Everything else (empty rows, short numeric rows,
+    # overflow before the first real row) is dropped.
+    not_na = df.notna()
+    num_not_na = not_na.sum(axis=1)
+    is_row = num_not_na >= 3
+    all_strings = (df.map(lambda v: isinstance(v, str)) | ~not_na).all(axis=1)
+    row_no = is_row.cumsum()
+    overflow = num_not_na.between(1, 2) & all_strings & (row_no > 0)
+
+    new_df = df[is_row].set_axis(row_no[is_row])
+    if overflow.any():
+        # One grouped concat per column instead of a .loc write per cell
+        tails = df[overflow].astype(object).fillna("").groupby(row_no[overflow]).sum()
+        for col in tails.columns:
+            tail = tails[col].reindex(new_df.index, fill_value="")
+            has_tail = tail != ""
+            if has_tail.any():
+                cells = new_df[col].astype(object)
+                new_df[col] = cells.where(~has_tail, cells.fillna("").astype(str) + tail)
+
+    return new_df.to_csv(index=False, na_rep='NA', quoting=1)
@@ -90,45 +90,54 @@ document.addEventListener('DOMContentLoaded', () => {
         });
 
         sortedTables.forEach(table => {
-            const tr = document.createElement('tr');
-            tr.id = `row-${table.uid}`;
-            
-            // USPTO_ID cell
-            const tdId = document.createElement('td');
-            tdId.textContent = table.uspto_id;
-            tr.appendChild(tdId);
-            
-            // Table_No cell
-            const tdNum = document.createElement('td');
-            tdNum.textContent = table.table_no;
-            tr.appendChild(tdNum);
-
-            // User-added columns
-            userColumns.forEach(col => {
-                const td = document.createElement('td');
-                td.className = 'status-cell';
-                td.dataset.columnName = col.name; // Tag cell for updates
-                const loadingSpan = document.createElement('span');
-                loadingSpan.className = 'status-badge loading';
-                loadingSpan.textContent = 'Loading...';
-                td.appendChild(loadingSpan);
-                tr.appendChild(td);
-            });
+            tableBody.appendChild(createProgressRow(table, userColumns));
+        });
+    }
 
-            // Empty cell for '+' button column
-            const placeholderCell = document.createElement('td');
-            tr.appendChild(placeholderCell);
-            
-            tableBody.appendChild(tr);
+    function createProgressRow(table, userColumns) {
+        const tr = document.createElement('tr');
+        tr.id = `row-${table.uid}`;
+        
+        // USPTO_ID cell
+        const tdId = document.createElement('td');
+        tdId.textContent = table.uspto_id;
+        tr.appendChild(tdId);
+        
+        // Table_No cell
+        const tdNum = document.createElement('td');
+        tdNum.textContent = table.table_no;
+        tr.appendChild(tdNum);
+
+        // User-added columns
+        userColumns.forEach(col => {
+            const td = document.createElement('td');
+            td.className = 'status-cell';
+            td.dataset.columnName = col.name; // Tag cell for updates
+            const loadingSpan = document.createElement('span');
+            loadingSpan.className = 'status-badge loading';
+            loadingSpan.textContent = 'Loading...';
+            td.appendChild(loadingSpan);
+            tr.appendChild(td);
         });
+
+        // Empty cell for '+' button column
+        const placeholderCell = document.createElement('td');
+        tr.appendChild(placeholderCell);
+        
+        return tr;
     }
 
     function updateProgressTable(tables) {
         const userColumns = columns.filter(c => c.name !== 'USPTO_ID' && c.name !== 'Table_No');
 
         Object.values(tables).forEach(table => {
-            const row = document.getElementById(`row-${table.uid}`);
-            if (!row) return;
+            let row = document.getElementById(`row-${table.uid}`);
+            // Tables are discovered while the task runs, so add rows as they appear
+            if (!row) {
+                row = createProgressRow(table, userColumns);
+                tableBody.appendChild(row);
+                startDotAnimation();
+            }
 
             // Only update if status has changed
             if (tableProgressData[table.uid]?.status !== table.status) {
@@ -511,25 +520,16 @@ document.addEventListener('DOMContentLoaded', () => {
             const result = await response.json();
             console.log('Extraction started:', result);
             
-            // The response now contains the initial table list
-            if (result.tables && Object.keys(result.tables).length > 0) {
-                tableProgressData = result.tables;
-                initializeProgressTable(tableProgressData);
+            // Poll for progress; tables are reported through /api/progress as
+            // they are discovered, and a task that is already complete (a
+            // repeated request) is downloaded on the first poll
+            if (result.task_id) {
+                startPolling(result.task_id);
             } else {
-                // If no tables are found, show the message and stop
+                // No task was started
                 statusEl.textContent = result.message || "No relevant tables found.";
                 searchButton.disabled = false;
                 renderBody([]); // Show empty state
-                return;
-            }
-            
-            // Start polling for progress if the task is not already complete
-            if (result.status !== 'completed' && result.task_id) {
-                startPolling(result.task_id);
-            } else {
-                // This case handles if discovery found nothing and completed immediately
-                statusEl.textContent = result.message;
-                searchButton.disabled = false;
             }
 
         } catch (err) {